@@ -1,28 +1,84 @@
+import atexit
+import logging
+import queue
+from functools import lru_cache, partial
+from logging.handlers import QueueHandler, QueueListener
+import orjson
 from flask import Flask, session
+from flask.json.provider import DefaultJSONProvider
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from flask_session import Session
 from werkzeug.middleware.proxy_fix import ProxyFix
 from app.config import Config
 from app.translations import TRANSLATIONS
 
 csrf = CSRFProtect()
 limiter = Limiter(key_func=get_remote_address)
+server_session = Session()
+_log_listener = None
+
+@lru_cache(maxsize=4096)
+def _translate(lang, key):
+    return TRANSLATIONS.get(lang, {}).get(key, key)
+
+@lru_cache(maxsize=8)
+def _lang_helpers(lang):
+    """Template helpers for one language, built once per process instead of once per render."""
+    return {"t": partial(_translate, lang), "get_lang": lambda: lang}
+
+def configure_logging(level=logging.INFO):
+    """Routes all log records through a queue so request and worker threads never block on stdout."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+
+    _log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serves jsonify()/request.json through orjson; /status is polled every second while a task runs."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 def create_app():
+    configure_logging()
+
     app = Flask(__name__, instance_relative_config=True)
+    app.json = OrjsonProvider(app)
     app.config.from_object(Config)
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
     csrf.init_app(app)
     limiter.init_app(app)
 
+    if app.config.get("REDIS_URL"):
+        import redis
+        app.config["SESSION_REDIS"] = redis.Redis.from_url(app.config["REDIS_URL"])
+        server_session.init_app(app)
+
     @app.context_processor
     def inject_content():
-        lang = session.get('lang', 'hy')
-        def t(key):
-            return TRANSLATIONS.get(lang, {}).get(key, key)
-        return dict(t=t, get_lang=lambda: lang)
+        return _lang_helpers(session.get('lang', 'hy'))
 
     from app.routes.home import home_bp
     from app.routes.results import results_bp
@@ -5,12 +5,40 @@ class Config:
 
     TEMP_DATA_DIR = os.path.join(os.getcwd(), "temp_data")
     USE_S3 = False
+    # Set when nginx serves TEMP_DATA_DIR as an internal location (e.g. "/internal/")
+    X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
+
+    # Raw /declaration/{id} responses, reused by retries and by other row_name extractions
+    CACHE_DIR = os.path.join(os.getcwd(), "cache_data")
+    DECLARATION_CACHE_TTL = 7 * 24 * 3600
+    DECLARATION_CACHE_SIZE_LIMIT = 512 * 1024 * 1024
+    # /declarations list pages, kept only long enough for "retry failed" runs of the same page
+    DECLARATION_LIST_CACHE_TTL = 3600
+    # Worker processes that decode declaration payloads off the GIL; 0 decodes on the event loop thread
+    DECODE_PROCESSES = int(os.environ.get("DECODE_PROCESSES", 0))
 
     CPC_BASE_URL = "https://file-online.cpcarmenia.am/armepdwebservice/v1"
     MAX_WORKERS = 3
+    MAX_CONCURRENT_TASKS = 2
+    MAX_QUEUED_TASKS = 10
+    TASK_STATUS_TTL = 3600  # seconds a task's status is kept after its last update
+    FINISHED_TASK_TTL = 300  # seconds a finished task's status stays readable
     REQUEST_TIMEOUT = 30
     USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
 
-    RATELIMIT_STORAGE_URI = "memory://"
+    REDIS_URL = os.environ.get("REDIS_URL")
+
+    # Shared across gunicorn workers when Redis is configured; "memory://" is per-process.
+    RATELIMIT_STORAGE_URI = REDIS_URL or "memory://"
+    RATELIMIT_STORAGE_OPTIONS = {"max_connections": 20} if REDIS_URL else {}
     RATELIMIT_STRATEGY = "fixed-window"
     RATELIMIT_DEFAULT = "2000 per day" # not used in code
+
+    # Server-side sessions (only enabled when REDIS_URL is set, see create_app)
+    SESSION_TYPE = "redis"
+    SESSION_PERMANENT = False
+    SESSION_KEY_PREFIX = "session:"
+    # Flask-Session stores every Redis session (even non-permanent ones) with this expiry;
+    # Flask's 31-day default would keep one key per cookieless /captcha-puzzle hit for a month
+    PERMANENT_SESSION_LIFETIME = 24 * 3600
+    CAPTCHA_TTL = 120  # seconds a generated puzzle stays valid
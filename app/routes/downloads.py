@@ -1,4 +1,4 @@
-from flask import Blueprint, send_file, flash, redirect, url_for
+from flask import Blueprint, Response, send_from_directory, flash, redirect, url_for, current_app
 from app.services.cache_service import get_dataset_download_info
 
 downloads_bp = Blueprint("downloads", __name__)
@@ -11,9 +11,23 @@ def download_csv(task_id):
         flash("File expired or deleted by the server reset.", "danger")
         return redirect(url_for("home.index"))
 
-    return send_file(
-        download_info["path"],
+    filename = f"{task_id}.csv"
+    download_name = f"cpc_data_{task_id}.csv"
+
+    accel_prefix = current_app.config.get("X_ACCEL_REDIRECT_PREFIX")
+    if accel_prefix:
+        # Let nginx stream the file itself
+        return Response("", mimetype="text/csv", headers={
+            "X-Accel-Redirect": f"{accel_prefix.rstrip('/')}/{filename}",
+            "Content-Disposition": f'attachment; filename="{download_name}"'
+        })
+
+    return send_from_directory(
+        current_app.config["TEMP_DATA_DIR"],
+        filename,
         mimetype="text/csv",
         as_attachment=True,
-        download_name=f"cpc_data_{task_id}.csv"
+        download_name=download_name,
+        conditional=True,
+        max_age=0
     )
@@ -1,4 +1,5 @@
 import random
+from types import MappingProxyType
 from urllib.parse import urlparse
 from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, current_app
 from app.services.task_manager import start_collection_task, get_task_status, stop_task
@@ -7,8 +8,10 @@ from app.translations import TRANSLATIONS
 from core.row_config import rows_dict, DECLARANT_TYPES, TYPE_OPTIONS, INST_GROUPS, INSTITUTIONS, GROUP_TO_INST
 import os
 import time
+import logging
 
 home_bp = Blueprint("home", __name__)
+logger = logging.getLogger(__name__)
 
 ICONS = {
     "icon_car": "fa-car",
@@ -22,8 +25,18 @@ ICONS = {
     "icon_heart": "fa-heart"
 }
 
+# Filter options never change at runtime, so the /tool context is built once
+TOOL_CONTEXT = MappingProxyType({
+    "rows_dict": rows_dict,
+    "declarant_types": DECLARANT_TYPES,
+    "type_options": TYPE_OPTIONS,
+    "inst_groups": INST_GROUPS,
+    "institutions": INSTITUTIONS,
+    "group_to_inst": GROUP_TO_INST
+})
+
 def cleanup_old_files():
-    """Deletes CSV files in temp_data that are older than 1 hour to prevent Render disk crashes."""
+    """Deletes CSV/Parquet files in temp_data that are older than 1 hour to prevent Render disk crashes."""
     temp_dir = current_app.config.get('TEMP_DATA_DIR')
 
     if not temp_dir or not os.path.exists(temp_dir):
@@ -34,16 +47,16 @@ def cleanup_old_files():
     for filename in os.listdir(temp_dir):
         filepath = os.path.join(temp_dir, filename)
 
-        if os.path.isfile(filepath) and filename.endswith('.csv'):
+        if os.path.isfile(filepath) and filename.endswith(('.csv', '.parquet')):
 
             file_modified_time = os.path.getmtime(filepath)
 
             if file_modified_time < (current_time - 3600):
                 try:
                     os.remove(filepath)
-                    print(f"System Cleanup: Deleted old file -> {filename}")
+                    logger.info("System Cleanup: Deleted old file -> %s", filename)
                 except Exception as e:
-                    print(f"System Cleanup Error: Could not delete {filename}. Error: {e}")
+                    logger.warning("System Cleanup Error: Could not delete %s. Error: %s", filename, e)
 
 @home_bp.route("/set-lang/<lang_code>")
 def set_language(lang_code):
@@ -72,15 +85,7 @@ def tool():
     """
     The main extraction tool page (formerly home).
     """
-    context = {
-        "rows_dict": rows_dict,
-        "declarant_types": DECLARANT_TYPES,
-        "type_options": TYPE_OPTIONS,
-        "inst_groups": INST_GROUPS,
-        "institutions": INSTITUTIONS,
-        "group_to_inst": GROUP_TO_INST
-    }
-    return render_template("home.html", **context)
+    return render_template("home.html", **TOOL_CONTEXT)
 
 
 @home_bp.route("/captcha-puzzle")
@@ -96,16 +101,14 @@ def get_captcha_puzzle():
 
     # 3. Generate Grid (3x3 = 9 items)
     num_correct = random.randint(2, 4)
-    grid_items = [target_class] * num_correct
     distractors = [v for k, v in ICONS.items() if k != target_key]
 
-    while len(grid_items) < 9:
-        grid_items.append(random.choice(distractors))
-
-    random.shuffle(grid_items)
+    correct_indices = sorted(random.sample(range(9), num_correct))
+    fillers = iter(random.choices(distractors, k=9 - num_correct))
+    grid_items = [target_class if i in correct_indices else next(fillers) for i in range(9)]
 
-    correct_indices = [i for i, x in enumerate(grid_items) if x == target_class]
-    session['captcha_solution'] = sorted(correct_indices)
+    session['captcha_solution'] = correct_indices
+    session['captcha_issued_at'] = time.time()
 
     return jsonify({
         "target_name": target_name,
@@ -121,8 +124,11 @@ def start_process():
             return jsonify({"error": "No JSON data received"}), 400
 
         user_selection = raw.get("captcha_selection", [])
-        real_solution = session.get("captcha_solution")
-        session.pop("captcha_solution", None)
+        real_solution = session.pop("captcha_solution", None)
+        issued_at = session.pop("captcha_issued_at", 0)
+
+        if time.time() - issued_at > current_app.config["CAPTCHA_TTL"]:
+            real_solution = None
 
         if not real_solution or not user_selection:
             return jsonify({"error": "CAPTCHA_FAIL"}), 400
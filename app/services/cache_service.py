@@ -1,22 +1,37 @@
 import os
-import pandas as pd
-import json
+import csv
+import orjson
 import time
 import uuid
 import glob
+import logging
+import tempfile
+import threading
+from functools import lru_cache
 from app.config import Config
 
+logger = logging.getLogger(__name__)
+
+HISTORY_INDEX_FILE = "_index.jsonl"
+HISTORY_FIELDS = ("task_id", "saved_at", "status", "filters", "total_rows", "stopped_early")
+
+_index_lock = threading.Lock()
+
 
 def create_task_id():
     """Generates a unique ID for the task."""
-    return str(uuid.uuid4())
+    return uuid.uuid4().hex
 
 
-def save_dataset(task_id, data, metadata, failed_ids):
+def save_dataset(task_id, columns, metadata, failed_ids):
     """
-    Saves the extracted data to CSV and metadata to JSON locally.
+    Saves the extracted data to Parquet (for loading) and CSV (for download),
+    and metadata to JSON locally.
+    `columns` maps each column name to its list of values (all of equal length).
     """
-    df = pd.DataFrame(data)
+    # pyarrow (and numpy under it) is imported on first use so it stays out of worker boot
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
     metadata["failed_ids"] = failed_ids
     metadata["saved_at"] = time.time()
@@ -28,81 +43,243 @@ def save_dataset(task_id, data, metadata, failed_ids):
         os.makedirs(Config.TEMP_DATA_DIR)
 
     csv_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.csv")
-    df.to_csv(csv_path, index=False)
+    with open(csv_path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*columns.values()))
+
+    parquet_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.parquet")
+    table = pa.table({name: _arrow_column(values) for name, values in columns.items()})
+    pq.write_table(table, parquet_path, compression="zstd")
 
     json_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.json")
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=4)
+    with open(json_path, 'wb') as f:
+        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+    _append_to_index(metadata)
 
     return task_id
 
 
+def _stringify(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float) and value != value:
+        return None
+    return str(value)
+
+
+def _arrow_column(values):
+    """
+    Arrow needs one type per column; cell values can mix numbers and text, in which case the column is stored as text.
+    Nested values are always stored as text, the way they appear in the CSV (Arrow would merge dict keys into a struct).
+    """
+    import pyarrow as pa
+
+    if not any(isinstance(v, (dict, list)) for v in values):
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+    return pa.array([_stringify(v) for v in values], type=pa.string())
+
+
+def _index_path():
+    return os.path.join(Config.TEMP_DATA_DIR, HISTORY_INDEX_FILE)
+
+
+def _index_entry(metadata):
+    return {k: metadata[k] for k in HISTORY_FIELDS if k in metadata}
+
+
+def _append_to_index(metadata):
+    """
+    Appends one line per saved task so /history never has to scan the directory.
+    Must be called after the task's JSON file is written, so a first-run rebuild includes it.
+    The dataset is already saved at this point, so index failures are logged rather than raised.
+    """
+    try:
+        line = orjson.dumps(_index_entry(metadata), option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+        with _index_lock:
+            if not os.path.exists(_index_path()) and _create_index():
+                return
+            with open(_index_path(), 'ab') as f:
+                f.write(line)
+    except Exception as e:
+        logger.error("Error updating history index for %s: %s", metadata.get("task_id"), e)
+
+
+def _create_index():
+    """
+    Builds the history index from the per-task JSON files (first run after upgrade).
+    Returns False if another writer created the index first; an existing index is never replaced,
+    so lines other workers append to it cannot be lost.
+    """
+    entries = []
+    for j_file in glob.glob(os.path.join(Config.TEMP_DATA_DIR, "*.json")):
+        try:
+            with open(j_file, 'rb') as f:
+                meta = orjson.loads(f.read())
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping unreadable metadata file %s: %s", j_file, e)
+            continue
+        meta.setdefault("task_id", os.path.splitext(os.path.basename(j_file))[0])
+        entries.append(_index_entry(meta))
+
+    # Unique temp file per writer, then a hard link that fails if the index already exists
+    fd, tmp_path = tempfile.mkstemp(dir=Config.TEMP_DATA_DIR, prefix=HISTORY_INDEX_FILE, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.writelines(orjson.dumps(e, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS) for e in entries)
+        try:
+            os.link(tmp_path, _index_path())
+        except FileExistsError:
+            return False
+    finally:
+        os.remove(tmp_path)
+    return True
+
+
 def load_dataset(task_id):
     """
-    Loads CSV data and JSON metadata from local storage.
+    Loads Parquet data (CSV for tasks saved before Parquet) and JSON metadata from local storage.
     Returns: (DataFrame, MetadataDict) or (None, None)
     """
+    # pandas costs hundreds of ms to import; only this (rarely used) full load needs it
+    import pandas as pd
+
     metadata = {}
 
     try:
+        parquet_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.parquet")
         csv_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.csv")
         json_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.json")
 
-        if not os.path.exists(csv_path) or not os.path.exists(json_path):
-            return None, None
-
-        with open(json_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        df = pd.read_csv(csv_path)
+        metadata = _read_metadata(json_path)
+        try:
+            df = pd.read_parquet(parquet_path, engine="pyarrow")
+        except FileNotFoundError:
+            df = pd.read_csv(csv_path)
 
         return df, metadata
 
+    except FileNotFoundError:
+        return None, None
     except pd.errors.EmptyDataError:
         return pd.DataFrame(), metadata
     except Exception as e:
-        print(f"Error loading cache for {task_id}: {e}")
+        logger.error("Error loading cache for %s: %s", task_id, e)
         return None, None
 
 
+def load_preview(task_id, n=50):
+    """
+    Loads the first `n` rows, the total row count and the metadata without reading the whole dataset.
+    Returns: (RowDicts, Columns, TotalRows, MetadataDict) or (None, None, None, None)
+    """
+    import pyarrow.parquet as pq
+
+    parquet_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.parquet")
+    csv_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.csv")
+    json_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.json")
+
+    try:
+        metadata = _read_metadata(json_path)
+        try:
+            parquet_file = pq.ParquetFile(parquet_path)
+        except FileNotFoundError:
+            return _load_csv_preview(csv_path, n) + (metadata,)
+
+        columns = parquet_file.schema_arrow.names
+        total_rows = parquet_file.metadata.num_rows
+        if total_rows == 0:
+            return [], columns, 0, metadata
+
+        # Row counts live in the Parquet footer; only the first batch is decoded
+        first_batch = next(parquet_file.iter_batches(batch_size=n))
+        return first_batch.to_pylist(), columns, total_rows, metadata
+
+    except FileNotFoundError:
+        return None, None, None, None
+    except Exception as e:
+        logger.error("Error loading preview for %s: %s", task_id, e)
+        return None, None, None, None
+
+
+def _load_csv_preview(csv_path, n):
+    """Preview for tasks saved before Parquet was introduced."""
+    import pandas as pd
+
+    try:
+        df = pd.read_csv(csv_path, nrows=n)
+    except pd.errors.EmptyDataError:
+        return [], [], 0
+
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        total_rows = sum(1 for _ in csv.reader(f)) - 1
+
+    return df.to_dict(orient="records"), df.columns.tolist(), total_rows
+
+
+@lru_cache(maxsize=256)
+def _parse_metadata(json_path, mtime_ns):
+    with open(json_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def _read_metadata(json_path):
+    """Parses a metadata file once per modification; rewrites change the mtime and miss the cache."""
+    return dict(_parse_metadata(json_path, os.stat(json_path).st_mtime_ns))
+
+
 def get_dataset_metadata(task_id):
     """Retrieves ONLY the metadata JSON for a task."""
     try:
         json_path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.json")
-        if not os.path.exists(json_path):
-            return None
-
-        with open(json_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_metadata(json_path)
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        print(f"Error loading metadata for {task_id}: {e}")
+        logger.error("Error loading metadata for %s: %s", task_id, e)
         return None
 
 
 def get_history():
     """
-    Scans the local storage for all completed tasks (JSON files).
+    Reads the history index of all completed tasks.
     Returns a list of metadata dictionaries sorted by date (newest first).
     """
     history_items = []
 
     try:
-        if not os.path.exists(Config.TEMP_DATA_DIR):
-            return []
+        if not os.path.exists(_index_path()):
+            if not os.path.isdir(Config.TEMP_DATA_DIR):
+                return []
+            with _index_lock:
+                _create_index()
 
-        json_files = glob.glob(os.path.join(Config.TEMP_DATA_DIR, "*.json"))
+        with open(_index_path(), 'rb') as f:
+            lines = f.read().splitlines()
 
-        for j_file in json_files:
-            with open(j_file, 'r', encoding='utf-8') as f:
-                meta = json.load(f)
-                ts = meta.get("saved_at", 0)
-                meta["date_str"] = time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))
-                if "status" not in meta:
-                    meta["status"] = "finished"
-                history_items.append(meta)
+        # A task can be listed twice if its save raced the first-run rebuild
+        by_id = {}
+        for line in lines:
+            try:
+                entry = orjson.loads(line)
+            except ValueError:
+                continue  # torn write from a crashed worker
+            by_id[entry.get("task_id")] = entry
+        entries = list(by_id.values())
+
+        for meta in entries:
+            ts = meta.get("saved_at", 0)
+            meta["date_str"] = time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))
+            if "status" not in meta:
+                meta["status"] = "finished"
+            history_items.append(meta)
 
     except Exception as e:
-        print(f"Error fetching history: {e}")
+        logger.error("Error fetching history: %s", e)
 
     history_items.sort(key=lambda x: x.get("saved_at", 0), reverse=True)
     return history_items
@@ -113,6 +290,8 @@ def get_dataset_download_info(task_id):
     Returns a dictionary indicating how to download the file from the local filesystem.
     """
     path = os.path.join(Config.TEMP_DATA_DIR, f"{task_id}.csv")
-    if os.path.exists(path):
-        return {"type": "file", "path": path}
-    return None
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+    return {"type": "file", "path": path, "size": size}
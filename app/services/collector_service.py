@@ -1,11 +1,14 @@
-import traceback
-from core.cpc_data_collector import CpcDataCollector
+import logging
 from .task_manager import task_manager
 
+logger = logging.getLogger(__name__)
+
 
 class CollectorService:
     @staticmethod
     def run_collection_task(task_id, form_data):
+        from core.cpc_data_collector import CpcDataCollector
+
         try:
             row_name = form_data.get('row_name')
             year = int(form_data.get('year'))
@@ -48,9 +51,9 @@ class CollectorService:
             task_manager.complete_task(task_id, {
                 'data': final_data,
                 'failed_ids': failed_items,
-                'total_records': len(final_data)
+                'total_records': collector.total_rows
             })
 
         except Exception as e:
-            print(traceback.format_exc())
+            logger.exception("[%s] Collection task failed", task_id)
             task_manager.fail_task(task_id, str(e))
@@ -1,52 +1,129 @@
+import asyncio
+import logging
 import threading
 import time
-import uuid
-import traceback
-from app.services.cache_service import save_dataset
-from core.cpc_data_collector import CpcDataCollector
+from app.config import Config
+from app.services.cache_service import save_dataset, create_task_id
+from app.services.task_store import create_task_store
+from core.stop_event import StopEvent
 
-TASKS = {}
-task_semaphore = threading.BoundedSemaphore(value=2)
+logger = logging.getLogger(__name__)
+
+TASKS = create_task_store()
+# Stop events of the tasks running in this process (threading objects cannot live in the store)
+_STOP_EVENTS = {}
+# All collections of this process run as coroutines on one event loop thread;
+# at most MAX_CONCURRENT_TASKS hold a slot at once, later ones wait for it
+_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, name="collector-loop", daemon=True).start()
+_TASK_SLOTS = asyncio.Semaphore(Config.MAX_CONCURRENT_TASKS)
+_queued = 0
+_queued_lock = threading.Lock()
+# The status page polls, so progress more frequent than this is never seen
+PROGRESS_INTERVAL = 0.1
+STATUS_FIELDS = ("status", "progress", "total", "message", "start_time")
+
+
+def _queue_depth():
+    return _queued
 
 
 def start_collection_task(filters):
-    if not task_semaphore.acquire(blocking=False):
-        raise Exception("Server is busy (Max 2 tasks running). Please try again in a few minutes.")
+    global _queued
+    with _queued_lock:
+        if _queued >= Config.MAX_QUEUED_TASKS:
+            raise Exception("Server is busy (too many tasks waiting). Please try again in a few minutes.")
+        _queued += 1
 
-    try:
-        task_id = str(uuid.uuid4())
-        stop_event = threading.Event()
+    task_id = create_task_id()
+    stop_event = StopEvent()
 
-        TASKS[task_id] = {
-            "status": "initializing",
+    try:
+        _STOP_EVENTS[task_id] = stop_event
+        TASKS.set(task_id, {
+            "status": "queued",
             "progress": 0,
             "total": 0,
             "start_time": time.time(),
-            "stop_event": stop_event,
-            "message": "Starting collection..."
-        }
+            "message": "Waiting for a free worker..."
+        })
+
+        asyncio.run_coroutine_threadsafe(_run_task(task_id, filters, stop_event), _LOOP)
+    except Exception:
+        # The task never reached the loop, so nothing else will release its queue place
+        _STOP_EVENTS.pop(task_id, None)
+        with _queued_lock:
+            _queued -= 1
+        raise
+
+    return task_id
+
+
+async def _wait_for_slot(stop_event):
+    """Waits for a free task slot; returns False (holding no slot) if the task is stopped first."""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    unsubscribe = stop_event.subscribe(lambda: loop.call_soon_threadsafe(stopped.set))
+    acquire = asyncio.ensure_future(_TASK_SLOTS.acquire())
+    stop_wait = asyncio.ensure_future(stopped.wait())
+    try:
+        await asyncio.wait({acquire, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        unsubscribe()
+        stop_wait.cancel()
+
+    if not stop_event.is_set():
+        return True
+    if acquire.done():
+        _TASK_SLOTS.release()
+    else:
+        acquire.cancel()
+    return False
 
-        thread = threading.Thread(target=_worker, args=(task_id, filters, stop_event))
-        thread.daemon = True
-        thread.start()
 
-        return task_id
+async def _run_task(task_id, filters, stop_event):
+    global _queued
+    try:
+        acquired = await _wait_for_slot(stop_event)
+    finally:
+        with _queued_lock:
+            _queued -= 1
+
+    if not acquired:
+        # Stopped while queued: _worker records the stopped result without occupying a slot
+        await _worker(task_id, filters, stop_event)
+        return
+    try:
+        await _worker(task_id, filters, stop_event)
+    finally:
+        _TASK_SLOTS.release()
 
-    except Exception as e:
-        task_semaphore.release()
-        raise e
 
+async def _worker(task_id, filters, stop_event):
+    # Imported here so web workers that never run a collection don't load the HTTP stack
+    from core.cpc_data_collector import CpcDataCollector
+
+    last_progress = [0.0]
 
-def _worker(task_id, filters, stop_event):
     def progress_callback(completed, total):
-        if task_id in TASKS:
-            TASKS[task_id]["progress"] = completed
-            TASKS[task_id]["total"] = total
-            TASKS[task_id]["status"] = "processing"
-            TASKS[task_id]["message"] = f"Processed {completed} of {total} items..."
+        now = time.monotonic()
+        if completed != total and now - last_progress[0] < PROGRESS_INTERVAL:
+            return
+        last_progress[0] = now
+        TASKS.update(task_id, progress=completed, total=total, status="processing",
+                     message=f"Processed {completed} of {total} items...")
 
     try:
-        print(f"[{task_id}] Starting Worker...")
+        logger.info("[%s] Starting Worker...", task_id)
+
+        if stop_event.is_set():
+            TASKS.update(task_id, status="stopped", message="Process stopped by user.")
+            metadata = {"filters": filters, "total_declarations": 0, "total_rows": 0,
+                        "stopped_early": True, "status": "stopped"}
+            await asyncio.to_thread(save_dataset, task_id, {}, metadata, [])
+            return
+
+        TASKS.update(task_id, status="initializing", message="Starting collection...")
 
         def safe_int(key, default=None):
             val = filters.get(key)
@@ -71,81 +148,83 @@ def _worker(task_id, filters, stop_event):
             retry_ids=filters.get("retry_ids")
         )
 
-        TASKS[task_id]["message"] = "Fetching initial declarations list..."
-        collector.get_declarations()
+        TASKS.update(task_id, message="Fetching initial declarations list...")
+        await asyncio.to_thread(collector.get_declarations)
 
         if not collector.declaration_list:
-            TASKS[task_id]["status"] = "finished"
-            TASKS[task_id]["message"] = "No declarations found."
+            TASKS.update(task_id, status="finished", message="No declarations found.")
             metadata = {"filters": filters, "total_declarations": 0, "total_rows": 0, "status": "finished"}
-            save_dataset(task_id, [], metadata, [])
+            await asyncio.to_thread(save_dataset, task_id, {}, metadata, [])
             return
 
-        TASKS[task_id]["total"] = len(collector.declaration_list)
-        TASKS[task_id]["message"] = "Downloading detailed row data..."
+        TASKS.update(task_id, total=len(collector.declaration_list), message="Downloading detailed row data...")
 
-        collector.get_row_data()
+        await collector.get_row_data_async()
 
+        # Formatting and writing files are CPU/disk work; keep them off the loop other tasks fetch on
         if stop_event.is_set():
-            TASKS[task_id]["status"] = "stopped"
-            TASKS[task_id]["message"] = "Process stopped by user."
-            collector.get_values()
-            final_data, failed_items = collector.merge_and_save()
+            TASKS.update(task_id, status="stopped", message="Process stopped by user.")
+            await asyncio.to_thread(collector.get_values)
+            final_data, failed_items = await asyncio.to_thread(collector.merge_and_save)
             metadata = {"filters": filters, "total_declarations": len(collector.declaration_list),
-                        "total_rows": len(final_data), "stopped_early": True, "status": "stopped"}
-            save_dataset(task_id, final_data, metadata, failed_items)
+                        "total_rows": collector.total_rows, "stopped_early": True, "status": "stopped"}
+            await asyncio.to_thread(save_dataset, task_id, final_data, metadata, failed_items)
             return
 
-        TASKS[task_id]["message"] = "Formatting data..."
-        collector.get_values()
-        final_data, failed_items = collector.merge_and_save()
+        TASKS.update(task_id, message="Formatting data...")
+        await asyncio.to_thread(collector.get_values)
+        final_data, failed_items = await asyncio.to_thread(collector.merge_and_save)
 
         metadata = {"filters": filters, "total_declarations": len(collector.declaration_list),
-                    "total_rows": len(final_data), "status": "finished"}
-        save_dataset(task_id, final_data, metadata, failed_items)
+                    "total_rows": collector.total_rows, "status": "finished"}
+        await asyncio.to_thread(save_dataset, task_id, final_data, metadata, failed_items)
 
-        TASKS[task_id]["status"] = "finished"
-        TASKS[task_id]["message"] = "Complete"
+        TASKS.update(task_id, status="finished", message="Complete")
 
     except Exception as e:
         error_msg = str(e)
-        if task_id in TASKS:
-            TASKS[task_id]["status"] = "error"
-            TASKS[task_id]["message"] = f"Error: {error_msg}"
-        print(f"[{task_id}] CRITICAL ERROR: {error_msg}")
-        traceback.print_exc()
+        TASKS.update(task_id, status="error", message=f"Error: {error_msg}")
+        logger.exception("[%s] CRITICAL ERROR: %s", task_id, error_msg)
 
     finally:
-        def cleanup():
-            TASKS.pop(task_id, None)
-
-        threading.Timer(300.0, cleanup).start()
-
-        try:
-            task_semaphore.release()
-        except ValueError:
-            pass
+        _STOP_EVENTS.pop(task_id, None)
+        # Keep the final status around briefly for the polling page, then let the store evict it
+        TASKS.expire(task_id, Config.FINISHED_TASK_TTL)
 
 
 def get_task_status(task_id):
+    # One snapshot per read: every field comes from the same update
     task = TASKS.get(task_id)
     if not task:
         return None
-    return {
-        "status": task["status"],
-        "progress": task["progress"],
-        "total": task["total"],
-        "message": task["message"],
-        "start_time": task["start_time"]
-    }
+    info = {field: task[field] for field in STATUS_FIELDS}
+    # The queue is per process; with Redis the poll may be served by a worker that doesn't hold it
+    if task["status"] == "queued" and not Config.REDIS_URL:
+        info["queue_size"] = _queue_depth()
+    return info
 
 
 def stop_task(task_id):
-    if task_id in TASKS:
-        TASKS[task_id]["stop_event"].set()
-        TASKS[task_id]["status"] = "stopping"
-        return True
-    return False
+    task = TASKS.get(task_id)
+    if task is None or task["status"] in ("finished", "stopped", "error"):
+        return False
+    TASKS.update(task_id, status="stopping")
+
+    stop_event = _STOP_EVENTS.get(task_id)
+    if stop_event is not None:
+        stop_event.set()
+    else:
+        TASKS.publish_stop(task_id)
+    return True
+
+
+def _on_remote_stop(task_id):
+    stop_event = _STOP_EVENTS.get(task_id)
+    if stop_event is not None:
+        stop_event.set()
+
+
+TASKS.listen_for_stops(_on_remote_stop)
 
 class TaskManager:
     pass
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from types import MappingProxyType
+import orjson
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# HSET only if the hash still exists, so a late update cannot resurrect an expired task;
+# ARGV[1] is the refreshed TTL, the rest are field/value pairs
+_UPDATE_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class MemoryTaskStore:
+    """
+    Per-process task status store, used when REDIS_URL is not configured.
+    Expired tasks are evicted by a single janitor thread, mirroring Redis key expiry.
+    """
+
+    SWEEP_INTERVAL = 30
+
+    def __init__(self):
+        self._tasks = {}
+        self._deadlines = {}
+        threading.Thread(target=self._sweep_forever, name="task-janitor", daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            now = time.monotonic()
+            for task_id, deadline in list(self._deadlines.items()):
+                if deadline <= now:
+                    self.delete(task_id)
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def set(self, task_id, fields, ttl=Config.TASK_STATUS_TTL):
+        self._tasks[task_id] = MappingProxyType(dict(fields))
+        self._deadlines[task_id] = time.monotonic() + ttl
+
+    def update(self, task_id, **fields):
+        # Publish a new read-only snapshot so readers never see a half-applied update
+        task = self._tasks.get(task_id)
+        if task is not None:
+            self._tasks[task_id] = MappingProxyType({**task, **fields})
+            # A task that is still being updated is alive; only idle tasks run out their TTL
+            self._deadlines[task_id] = time.monotonic() + Config.TASK_STATUS_TTL
+
+    def expire(self, task_id, ttl):
+        if task_id in self._tasks:
+            self._deadlines[task_id] = time.monotonic() + ttl
+
+    def delete(self, task_id):
+        self._tasks.pop(task_id, None)
+        self._deadlines.pop(task_id, None)
+
+    def publish_stop(self, task_id):
+        # Only one process can own the task, and it has already been checked
+        pass
+
+    def listen_for_stops(self, callback):
+        pass
+
+
+class RedisTaskStore:
+    """
+    Task status shared by all gunicorn workers.
+    Each task is a hash `task:{id}` whose fields hold JSON-encoded values.
+    """
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._update_script = self._redis.register_script(_UPDATE_IF_EXISTS)
+        self._pubsub_thread = None
+
+    @staticmethod
+    def _key(task_id):
+        return f"task:{task_id}"
+
+    def get(self, task_id):
+        raw = self._redis.hgetall(self._key(task_id))
+        if not raw:
+            return None
+        return {k.decode(): orjson.loads(v) for k, v in raw.items()}
+
+    def set(self, task_id, fields, ttl=Config.TASK_STATUS_TTL):
+        key = self._key(task_id)
+        with self._redis.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in fields.items()})
+            pipe.expire(key, ttl)
+            pipe.execute()
+
+    def update(self, task_id, **fields):
+        args = [Config.TASK_STATUS_TTL]
+        for k, v in fields.items():
+            args += [k, orjson.dumps(v)]
+        self._update_script(keys=[self._key(task_id)], args=args)
+
+    def expire(self, task_id, ttl):
+        self._redis.expire(self._key(task_id), ttl)
+
+    def delete(self, task_id):
+        self._redis.delete(self._key(task_id))
+
+    def publish_stop(self, task_id):
+        """Asks whichever worker process owns the task to stop it."""
+        self._redis.publish(f"stop:{task_id}", b"1")
+
+    def listen_for_stops(self, callback):
+        """Calls `callback(task_id)` from a background thread for every stop request published."""
+        if self._pubsub_thread is not None:
+            return
+
+        def handler(message):
+            channel = message["channel"].decode()
+            callback(channel.split(":", 1)[1])
+
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{"stop:*": handler})
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+def create_task_store():
+    if Config.REDIS_URL:
+        logger.info("Task status is stored in Redis")
+        return RedisTaskStore(Config.REDIS_URL)
+    return MemoryTaskStore()
@@ -1,14 +1,101 @@
+import asyncio
+import itertools
+import multiprocessing
+import sys
+import diskcache
 import requests
-import concurrent.futures
-import json
+import orjson
+import logging
+import httpx
 import urllib3
+from concurrent.futures import ProcessPoolExecutor
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 from app.config import Config
 from core.row_config import rows_dict
+from core.stop_event import StopEvent
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+logger = logging.getLogger(__name__)
+
+# Mirrors the urllib3 Retry policy mounted on the requests session
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 2
+
+
+def _backoff_delay(attempt):
+    return 0 if attempt == 0 else min(BACKOFF_FACTOR * 2 ** attempt, 120)
+
+
+# Key chains are resolved once at import; tuples keep them immutable while shared across tasks
+_KEY_CHAINS = {name: tuple(chain) for name, chain in rows_dict.items()}
+
+
+_declaration_cache = None
+
+
+def get_declaration_cache():
+    """Process-wide on-disk LRU cache of raw declaration payloads (safe across threads and processes)."""
+    global _declaration_cache
+    if _declaration_cache is None:
+        _declaration_cache = diskcache.Cache(
+            Config.CACHE_DIR,
+            size_limit=Config.DECLARATION_CACHE_SIZE_LIMIT,
+            eviction_policy="least-recently-used"
+        )
+    return _declaration_cache
+
+
+def _cache_get(key):
+    """Best-effort cache read: the cache is only an optimisation, so any failure counts as a miss."""
+    try:
+        return get_declaration_cache().get(key)
+    except Exception as e:
+        logger.warning("Declaration cache read failed for %s: %s", key, e)
+        return None
+
+
+def _cache_set(key, value, expire):
+    """Best-effort cache write (e.g. a full disk must not fail the declarant that was just fetched)."""
+    try:
+        get_declaration_cache().set(key, value, expire=expire)
+    except Exception as e:
+        logger.warning("Declaration cache write failed for %s: %s", key, e)
+
+
+_decode_pool = None
+
+
+def get_decode_pool():
+    """Process pool for payload decoding, or None when Config.DECODE_PROCESSES is 0."""
+    global _decode_pool
+    if _decode_pool is None and Config.DECODE_PROCESSES > 0:
+        # forkserver: forking the threaded web process directly could copy held locks
+        _decode_pool = ProcessPoolExecutor(
+            max_workers=Config.DECODE_PROCESSES,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    return _decode_pool
+
+
+def _intern(name):
+    """Header names repeat across every declarant of a task; share one string object per name."""
+    return sys.intern(name) if isinstance(name, str) else name
+
+
+def _decode_and_extract(body, key_chain):
+    """
+    Parses a raw declaration payload and pulls out the section at key_chain.
+    Returns: (is_valid_json, section); only the section is sent back from a decode process.
+    """
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return False, None
+    return True, CpcDataCollector._safe_extract(data, key_chain)
+
 
 class CpcDataCollector:
     def __init__(self, row_name, year, declarant_type, t_type,
@@ -32,14 +119,18 @@ class CpcDataCollector:
         self.declarant_ids: list = []
         self.rows_by_id: dict = {}
         self.headers_by_id: dict = {}
-        self.final_data: list = []
+        self.final_data: dict = {}
+        self.total_rows: int = 0
         self.failed_items: list = []
 
         self.session = requests.Session()
         self.session.verify = False
 
-        retries = Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504])
-        self.session.mount("https://", HTTPAdapter(max_retries=retries))
+        retries = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=sorted(RETRY_STATUSES))
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=Config.MAX_WORKERS,
+                              pool_maxsize=Config.MAX_WORKERS, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.session.headers.update({"User-Agent": Config.USER_AGENT})
 
     def _safe_request(self, method, url, **kwargs):
@@ -50,13 +141,33 @@ class CpcDataCollector:
         except requests.exceptions.HTTPError as e:
             raise Exception(f"API Error {e.response.status_code}")
         except requests.exceptions.ConnectionError as e:
-            print(f"Underlying Connection Error: {e}")
+            logger.warning("Underlying Connection Error: %s", e)
             raise Exception("Connection failed")
         except requests.exceptions.Timeout:
             raise Exception("Timeout")
         except Exception as e:
             raise Exception(str(e))
 
+    async def _safe_request_async(self, client, method, url, **kwargs):
+        """Async counterpart of `_safe_request`: same retry policy, same error messages."""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                resp = await client.request(method, url, **kwargs)
+                if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    resp.raise_for_status()
+                    return resp.content
+            except httpx.HTTPStatusError as e:
+                raise Exception(f"API Error {e.response.status_code}")
+            except httpx.TimeoutException:
+                if attempt == MAX_RETRIES:
+                    raise Exception("Timeout")
+            except httpx.TransportError as e:
+                if attempt == MAX_RETRIES:
+                    logger.warning("Underlying Connection Error: %s", e)
+                    raise Exception("Connection failed")
+
+            await asyncio.sleep(_backoff_delay(attempt))
+
     def get_declarations(self):
         if self.stop_event and self.stop_event.is_set():
             return [], []
@@ -74,9 +185,16 @@ class CpcDataCollector:
             "paging": {"offset": self.offset, "limit": self.limit}
         }
 
+        cache_key = "list:" + orjson.dumps(payload, option=orjson.OPT_SORT_KEYS).decode()
+
         try:
-            resp = self._safe_request("POST", base_url, json=payload)
-            data = resp.json().get("data", [])
+            # Retries re-read the page their original run fetched instead of downloading it again;
+            # cache errors are logged and never fail the listing
+            body = _cache_get(cache_key) if self.retry_ids else None
+            if body is None:
+                body = self._safe_request("POST", base_url, json=payload).content
+                _cache_set(cache_key, body, Config.DECLARATION_LIST_CACHE_TTL)
+            data = orjson.loads(body).get("data", [])
 
             if self.retry_ids:
                 retry_set = set(map(int, self.retry_ids))
@@ -87,7 +205,7 @@ class CpcDataCollector:
             return self.declaration_list, self.declarant_ids
 
         except Exception as e:
-            print(f"List Fetch Error: {e}")
+            logger.error("List Fetch Error: %s", e)
             return [], []
 
     @staticmethod
@@ -101,110 +219,207 @@ class CpcDataCollector:
                 return None
         return current
 
-    def _fetch_single_row(self, declarant_id, key_chain):
+    @staticmethod
+    async def _decode_section(body, key_chain):
+        pool = get_decode_pool()
+        if pool is None:
+            return _decode_and_extract(body, key_chain)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, _decode_and_extract, body, key_chain)
+
+    async def _fetch_single_row(self, client, declarant_id, key_chain):
         # 1. IMMEDIATE CHECK: If stopped, do not make any network requests or proceed
         if self.stop_event and self.stop_event.is_set():
             return declarant_id, None, "Stopped"
 
         url = f"{Config.CPC_BASE_URL}/declaration/{declarant_id}"
+        cache_key = f"decl:{self.year}:{declarant_id}"
 
         try:
-            resp = self._safe_request("GET", url)
+            # The whole payload is cached, so any row_name can be extracted from it later.
+            # Cache calls are blocking SQLite I/O (plus eviction); keep them off the shared event loop
+            body = await asyncio.to_thread(_cache_get, cache_key)
+            cached = body is not None
+            if not cached:
+                if self.stop_event and self.stop_event.is_set():
+                    return declarant_id, None, "Stopped"
+
+                async with self._request_slots:
+                    body = await self._safe_request_async(client, "GET", url)
 
             if self.stop_event and self.stop_event.is_set():
                 return declarant_id, None, "Stopped"
 
-            data = resp.json()
-            section = self._safe_extract(data, key_chain)
+            is_valid_json, section = await self._decode_section(body, key_chain)
+            if not is_valid_json:
+                return declarant_id, None, "Invalid JSON"
+            if not cached:
+                await asyncio.to_thread(_cache_set, cache_key, body, Config.DECLARATION_CACHE_TTL)
 
             if section is None:
                 return declarant_id, None, "Data section not found"
             return declarant_id, section, None
 
-        except json.JSONDecodeError:
-            return declarant_id, None, "Invalid JSON"
+        except asyncio.CancelledError:
+            # Only _fetch_all_rows cancels these tasks, and only once the collection is stopped
+            return declarant_id, None, "Stopped"
         except Exception as e:
             return declarant_id, None, str(e)
 
     def get_row_data(self):
-        key_chain = rows_dict.get(self.row_name)
+        # Runs on the calling thread; the event loop lives only for this fetch
+        return asyncio.run(self.get_row_data_async())
+
+    async def get_row_data_async(self):
+        """Same as get_row_data, for callers that already run an event loop."""
+        key_chain = _KEY_CHAINS.get(self.row_name)
         if not key_chain:
             return {}
 
-        total = len(self.declarant_ids)
-        if total == 0:
+        if not self.declarant_ids:
             return {}
 
+        await self._fetch_all_rows(key_chain)
+        return self.rows_by_id
+
+    async def _fetch_all_rows(self, key_chain):
+        total = len(self.declarant_ids)
         completed = 0
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as executor:
-            future_to_id = {
-                executor.submit(self._fetch_single_row, d_id, key_chain): d_id
+        # Over HTTP/2 all requests share one multiplexed connection (one TLS handshake);
+        # if the server only speaks HTTP/1.1 the pool still allows MAX_WORKERS parallel sockets
+        limits = httpx.Limits(max_connections=Config.MAX_WORKERS, max_keepalive_connections=Config.MAX_WORKERS)
+        # Connection limits don't bound HTTP/2 streams: cap in-flight requests (with their retries)
+        # at MAX_WORKERS per task, the load the CPC API saw from the old thread pool
+        self._request_slots = asyncio.Semaphore(Config.MAX_WORKERS)
+
+        async with httpx.AsyncClient(http2=True, verify=False, limits=limits, timeout=Config.REQUEST_TIMEOUT,
+                                     headers={"User-Agent": Config.USER_AGENT}) as client:
+            tasks = [
+                asyncio.create_task(self._fetch_single_row(client, d_id, key_chain))
                 for d_id in self.declarant_ids
-            }
+            ]
 
-            futures_set = set(future_to_id.keys())
+            # Abort in-flight requests as soon as a stop is requested instead of waiting for them to finish
+            unsubscribe = lambda: None
+            if isinstance(self.stop_event, StopEvent):
+                loop = asyncio.get_running_loop()
 
-            while futures_set:
-                if self.stop_event and self.stop_event.is_set():
-                    executor.shutdown(wait=False, cancel_futures=True)
-                    break
+                def cancel_pending():
+                    for task in tasks:
+                        task.cancel()
 
-                done, _ = concurrent.futures.wait(
-                    futures_set,
-                    timeout=0.5,
-                    return_when=concurrent.futures.FIRST_COMPLETED
-                )
+                def on_stop():
+                    try:
+                        loop.call_soon_threadsafe(cancel_pending)
+                    except RuntimeError:
+                        pass  # loop already closed, nothing left to cancel
 
-                for future in done:
-                    futures_set.remove(future)
-                    declarant_id = future_to_id[future]
+                unsubscribe = self.stop_event.subscribe(on_stop)
 
-                    try:
-                        _, result, error_reason = future.result()
-                        if result is not None:
-                            self.rows_by_id[declarant_id] = result
-                        elif error_reason != "Stopped":
-                            self.failed_items.append({'id': declarant_id, 'reason': error_reason})
-                    except Exception as e:
-                        self.failed_items.append({'id': declarant_id, 'reason': str(e)})
+            try:
+                for future in asyncio.as_completed(tasks):
+                    declarant_id, result, error_reason = await future
+                    if result is not None:
+                        # Shape each section while later responses are still in flight
+                        self._store_section(declarant_id, result)
+                    elif error_reason != "Stopped":
+                        self.failed_items.append({'id': declarant_id, 'reason': error_reason})
 
                     completed += 1
                     if self.progress_callback:
                         self.progress_callback(completed, total)
 
-        return self.rows_by_id
+                    if self.stop_event and self.stop_event.is_set():
+                        break
+            finally:
+                unsubscribe()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _store_section(self, declarant_id, section):
+        """Finds the header items and rows in a fetched section and keeps each row as a {header: value} dict."""
+        headers, rows = [], []
+        table_rows = False
+        if isinstance(section, dict) and "rows" in section:
+            headers = [_intern(h["name"]) for h in section.get("headerItems", [])]
+            rows = section["rows"]
+            table_rows = True
+        elif isinstance(section, dict) and "cells" in section:
+            for cell in section["cells"]:
+                v = cell.get("value")
+                if isinstance(v, dict) and "rows" in v:
+                    headers = [_intern(h["name"]) for h in v.get("headerItems", [])]
+                    rows = v["rows"]
+                    table_rows = True
+        elif isinstance(section, list):
+            rows = section
+        self.headers_by_id[declarant_id] = headers
+
+        # Rows of a table section all carry "cells", so the shape check is done once per declarant
+        shaped = None
+        if table_rows:
+            try:
+                shaped = [self._cells_row_values(row, headers) for row in rows]
+            except (KeyError, TypeError, AttributeError):
+                shaped = None  # mixed row shapes, fall back to per-row dispatch
+        if shaped is None:
+            shaped = [self._extract_row_values(row, headers) for row in rows]
+        self.rows_by_id[declarant_id] = shaped
 
     def get_values(self):
-        for declarant_id, section in self.rows_by_id.items():
-            headers, rows = [], []
-            if isinstance(section, dict) and "rows" in section:
-                headers = [h["name"] for h in section.get("headerItems", [])]
-                rows = section["rows"]
-            elif isinstance(section, dict) and "cells" in section:
-                for cell in section["cells"]:
-                    v = cell.get("value")
-                    if isinstance(v, dict) and "rows" in v:
-                        headers = [h["name"] for h in v.get("headerItems", [])]
-                        rows = v["rows"]
-            elif isinstance(section, list):
-                rows = section
-            self.headers_by_id[declarant_id] = headers
-            self.rows_by_id[declarant_id] = rows
+        # Sections are shaped as they arrive (see _store_section); kept for callers of the staged API
         return self.rows_by_id, self.headers_by_id
 
-    def _extract_row_values(self, row):
-        if isinstance(row, list):
-            headers = [f"col_{i + 1}" for i in range(len(row))]
-            return headers, row
+    def _extract_row_values(self, row, headers=None):
+        """
+        Maps one row's values to column names, padding missing values with None.
+        `headers` (the section's header items) take precedence over the row's own cell titles.
+        """
         if isinstance(row, dict) and "cells" in row:
-            values = [c.get("value") for c in row["cells"]]
-            headers = [c.get("title") or f"col_{i + 1}" for i, c in enumerate(row["cells"])]
-            return headers, values
-        return [], []
+            return self._cells_row_values(row, headers)
+        if isinstance(row, list):
+            values = row
+            if not headers:
+                headers = [_intern(f"col_{i + 1}") for i in range(len(row))]
+        else:
+            values = []
+            headers = headers or []
+        return dict(zip(headers, itertools.chain(values, itertools.repeat(None))))
+
+    @staticmethod
+    def _cells_row_values(row, headers):
+        """_extract_row_values for a {"cells": [...]} row, without the shape checks."""
+        cells = row["cells"]
+        values = [c.get("value") for c in cells]
+        if not headers:
+            headers = [_intern(c.get("title") or f"col_{i + 1}") for i, c in enumerate(cells)]
+        return dict(zip(headers, itertools.chain(values, itertools.repeat(None))))
+
+    @staticmethod
+    def _append_record(columns, n_rows, fields):
+        """Appends one output row to the column lists; columns first seen now are back-filled with None."""
+        for key, value in fields:
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * n_rows
+            if len(column) > n_rows:
+                column[-1] = value  # later field wins, as with dict assignment
+            else:
+                column.append(value)
+        for column in columns.values():
+            if len(column) == n_rows:
+                column.append(None)
 
     def merge_and_save(self):
-        final_data = []
+        """
+        Joins each declarant's header fields with its rows.
+        Rows are released from `rows_by_id` as they are copied, so the batch is not held twice.
+        Returns: ({column: [values]}, failed_items); every column list has `self.total_rows` entries.
+        """
+        columns = {}
+        n_rows = 0
         failed_id_set = {item['id'] for item in self.failed_items}
 
         for person in self.declaration_list:
@@ -212,21 +427,19 @@ class CpcDataCollector:
             if d_id in failed_id_set:
                 continue
 
-            rows = self.rows_by_id.get(d_id, [])
+            rows = self.rows_by_id.pop(d_id, [])
             headers = self.headers_by_id.get(d_id, [])
 
             if not rows:
-                record = person.copy()
-                for h in headers: record[h] = None
-                final_data.append(record)
+                self._append_record(columns, n_rows, itertools.chain(
+                    person.items(), zip(headers, itertools.repeat(None))))
+                n_rows += 1
                 continue
 
-            for row in rows:
-                row_headers, values = self._extract_row_values(row)
-                eff_headers = headers or row_headers
-                record = person.copy()
-                for i, h in enumerate(eff_headers):
-                    record[h] = values[i] if i < len(values) else None
-                final_data.append(record)
-        self.final_data = final_data
+            for row_values in rows:
+                self._append_record(columns, n_rows, itertools.chain(person.items(), row_values.items()))
+                n_rows += 1
+
+        self.final_data = columns
+        self.total_rows = n_rows
         return self.final_data, self.failed_items
@@ -0,0 +1,37 @@
+import threading
+
+
+class StopEvent(threading.Event):
+    """
+    threading.Event that also notifies subscribers when it is set,
+    so code blocked on something else (e.g. network I/O) can react without polling.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """
+        Calls `callback()` once when the event is set (right away if it already is).
+        Returns a function that removes the subscription.
+        """
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._unsubscribe(callback)
+        callback()
+        return lambda: None
+
+    def _unsubscribe(self, callback):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def set(self):
+        with self._callbacks_lock:
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()